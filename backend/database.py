@@ -2,19 +2,41 @@
 Database Configuration - SQLAlchemy
 """
 
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 # SQLite database URL
 SQLALCHEMY_DATABASE_URL = "sqlite:///./covid_services.db"
 
+# Debug mode: turn accidental lazy loads into errors (see main.eager)
+DEBUG = os.getenv("DEBUG", "").lower() in ("1", "true", "yes")
+
 # Create engine
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, 
-    connect_args={"check_same_thread": False}  # Needed for SQLite
+    connect_args={"check_same_thread": False},  # Needed for SQLite
+    pool_size=20,
+    max_overflow=20,
+    pool_timeout=30,
+    pool_pre_ping=True,  # Detect stale connections on checkout
+    pool_recycle=1800
 )
 
+# SQLite connection pragmas: WAL lets readers and the writer run concurrently
+if SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        """Apply pragmas to every new SQLite connection"""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-64000")  # 64 MB
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
 # Create SessionLocal class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -3,27 +3,41 @@ COVID-Safe Home Services - FastAPI Backend
 Main application file
 """
 
-from fastapi import FastAPI, Depends, HTTPException, status, Request
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import select, insert, union_all, func, case
+from sqlalchemy.orm import Session, joinedload, raiseload, undefer
 from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_HALF_UP
 from typing import Optional, List
+from pydantic import TypeAdapter
+import logging
+import os
+import queue
 import secrets
-import hashlib
+import threading
+import time
+import xxhash
+from blake3 import blake3
 
-from database import engine, SessionLocal, Base
+from database import engine, SessionLocal, Base, DEBUG
 import models
 import schemas
 from auth import (
     verify_password, 
+    password_needs_rehash,
     get_password_hash, 
     create_access_token, 
+    get_db,
     get_current_user,
     SECRET_KEY,
     ALGORITHM
 )
 
+logger = logging.getLogger(__name__)
+
 # Create database tables
 Base.metadata.create_all(bind=engine)
 
@@ -31,7 +45,8 @@ Base.metadata.create_all(bind=engine)
 app = FastAPI(
     title="COVID-Safe Home Services API",
     description="Privacy-by-design home services platform with contact tracing",
-    version="3.0"
+    version="3.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
@@ -43,64 +58,197 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Privacy log write-behind queue, flushed in batches by a background thread
+PRIVACY_LOG_BATCH_SIZE = 100
+PRIVACY_LOG_FLUSH_INTERVAL = 0.5  # seconds
+_privacy_log_queue = queue.Queue()
+_privacy_log_stop = threading.Event()
+_privacy_log_worker = None
+
+@app.on_event("startup")
+def start_privacy_log_worker():
+    """Start the background privacy log writer"""
+    global _privacy_log_worker
+    _privacy_log_stop.clear()
+    _privacy_log_worker = threading.Thread(target=flush_privacy_logs, name="privacy-log-flush", daemon=True)
+    _privacy_log_worker.start()
+
+@app.on_event("shutdown")
+def stop_privacy_log_worker():
+    """Stop the privacy log writer once it has drained the queue"""
+    _privacy_log_stop.set()
+    if _privacy_log_worker:
+        _privacy_log_worker.join()
+
+# Service listing cache: (version, service_type, skip, limit) -> (expires_at, JSON body)
+SERVICES_CACHE_TTL = 30  # seconds
+SERVICES_CACHE_MAX_ENTRIES = 1024
+services_list_adapter = TypeAdapter(List[schemas.ServiceResponse])
+_services_cache = {}
+_services_cache_version = 0
+
+def invalidate_services_cache():
+    """Drop cached service listings after a service is created, updated or deleted"""
+    global _services_cache_version
+    _services_cache_version += 1
+    _services_cache.clear()
+
+# Booking listings are streamed in batches instead of materialized at once
+BOOKINGS_STREAM_BATCH_SIZE = 500
+bookings_list_adapter = TypeAdapter(List[schemas.BookingResponse])
+
+# Random tokens are sliced from a per-thread buffer of os.urandom bytes
+ENTROPY_POOL_SIZE = 4096
+
+class EntropyPool:
+    """Buffer of os.urandom bytes, refilled ENTROPY_POOL_SIZE bytes at a time"""
+    
+    def __init__(self):
+        self.buffer = os.urandom(ENTROPY_POOL_SIZE)
+        self.offset = 0
+    
+    def take(self, nbytes: int) -> bytes:
+        """Take the next nbytes unused random bytes"""
+        if self.offset + nbytes > len(self.buffer):
+            self.buffer = os.urandom(ENTROPY_POOL_SIZE)
+            self.offset = 0
+        chunk = self.buffer[self.offset:self.offset + nbytes]
+        self.offset += nbytes
+        return chunk
+
+_entropy = threading.local()
+
+def _reset_entropy():
+    """Forked workers must not reuse the parent's buffered bytes"""
+    global _entropy
+    _entropy = threading.local()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_entropy)
+
+def token_hex(nbytes: int) -> str:
+    """Drop-in for secrets.token_hex backed by this thread's entropy pool"""
+    pool = getattr(_entropy, "pool", None)
+    if pool is None:
+        pool = _entropy.pool = EntropyPool()
+    return pool.take(nbytes).hex()
 
 # Utility functions
+OTP_HASH_KEY = blake3(SECRET_KEY.encode()).digest()
+
+def eager(*options):
+    """Query loader options; in DEBUG mode any other lazy load raises"""
+    if DEBUG:
+        return (*options, raiseload("*"))
+    return options
+
 def hash_data(data: str) -> str:
-    """Hash sensitive data using SHA-256"""
-    return hashlib.sha256(data.encode()).hexdigest()
+    """Hash sensitive data using BLAKE3"""
+    return blake3(data.encode()).hexdigest()
+
+def hash_ip(ip: str) -> str:
+    """Bucket an IP address with non-cryptographic xxh3"""
+    return xxhash.xxh3_64_hexdigest(ip.encode())
 
 def generate_anonymous_id() -> str:
     """Generate unique anonymous ID"""
-    return f"ANON-{secrets.token_hex(16)}"
+    return f"ANON-{token_hex(16)}"
 
 def generate_otp() -> str:
     """Generate 6-digit OTP"""
     return str(secrets.randbelow(900000) + 100000)
 
+def hash_otp(otp: str) -> bytes:
+    """Hash an OTP with keyed BLAKE3 so stored hashes can't be brute-forced offline"""
+    return blake3(otp.encode(), key=OTP_HASH_KEY).digest()[:16]
+
+# (epoch second, formatted timestamp), swapped as one tuple so threads never see a mixed pair
+_payment_timestamp_cache = (0, '')
+
+def payment_timestamp() -> str:
+    """Local time as YYYYmmddHHMMSS, formatted at most once per second"""
+    global _payment_timestamp_cache
+    now = int(time.time())
+    cached_at, timestamp = _payment_timestamp_cache
+    if now != cached_at:
+        timestamp = time.strftime('%Y%m%d%H%M%S', time.localtime(now))
+        _payment_timestamp_cache = (now, timestamp)
+    return timestamp
+
 def generate_payment_reference() -> str:
     """Generate payment reference"""
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    random_part = secrets.token_hex(4).upper()
+    timestamp = payment_timestamp()
+    random_part = token_hex(4).upper()
     return f"PAY-{timestamp}-{random_part}"
 
-def calculate_payment_amounts(price: float):
+PLATFORM_FEE_RATE = Decimal('0.05')
+CENTS = Decimal('0.01')
+
+def calculate_payment_amounts(price: Decimal):
     """Calculate payment breakdown with 5% platform fee"""
-    platform_fee = round(price * 0.05, 2)
-    provider_amount = round(price - platform_fee, 2)
+    platform_fee = (price * PLATFORM_FEE_RATE).quantize(CENTS, rounding=ROUND_HALF_UP)
+    provider_amount = price - platform_fee
     return {
         'total': price,
         'platform_fee': platform_fee,
         'provider_amount': provider_amount
     }
 
+CARD_TYPES = {'4': 'Visa', '5': 'Mastercard', '3': 'American Express'}
+
 def get_card_type(card_number: str) -> str:
     """Determine card type from number"""
-    if card_number.startswith('4'):
-        return 'Visa'
-    elif card_number.startswith('5'):
-        return 'Mastercard'
-    elif card_number.startswith('3'):
-        return 'American Express'
-    return 'Unknown'
-
-def log_privacy_action(db: Session, user_id: int, action: str, resource: str = None):
-    """Log privacy-related actions"""
-    log = models.PrivacyLog(
-        user_id=user_id,
-        action=action,
-        resource=resource,
-        ip_hash=hash_data("127.0.0.1"),  # In production, get real IP
-        timestamp=datetime.now()
-    )
-    db.add(log)
-    db.commit()
+    return CARD_TYPES.get(card_number[:1], 'Unknown')
+
+def stream_bookings(partitions):
+    """Serialize booking batches into a single JSON array, one batch at a time"""
+    yield b"["
+    first = True
+    for partition in partitions:
+        body = bookings_list_adapter.dump_json(bookings_list_adapter.validate_python(partition))
+        if not first:
+            yield b","
+        yield body[1:-1]  # Strip the batch's own brackets
+        first = False
+    yield b"]"
+
+def log_privacy_action(user_id: int, action: str, resource: str = None):
+    """Log privacy-related actions (queued, written by flush_privacy_logs)"""
+    _privacy_log_queue.put_nowait({
+        "user_id": user_id,
+        "action": action,
+        "resource": resource,
+        "ip_hash": hash_ip("127.0.0.1"),  # In production, get real IP
+        "timestamp": datetime.now()
+    })
+
+def flush_privacy_logs():
+    """Background worker: insert queued privacy logs in batches"""
+    while not (_privacy_log_stop.is_set() and _privacy_log_queue.empty()):
+        try:
+            rows = [_privacy_log_queue.get(timeout=PRIVACY_LOG_FLUSH_INTERVAL)]
+        except queue.Empty:
+            continue
+        
+        # Collect more rows until the batch is full or the interval elapses
+        deadline = time.monotonic() + PRIVACY_LOG_FLUSH_INTERVAL
+        while len(rows) < PRIVACY_LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(_privacy_log_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        
+        db = SessionLocal()
+        try:
+            db.execute(insert(models.PrivacyLog), rows)
+            db.commit()
+        except Exception:
+            logger.exception("Failed to write %d privacy logs", len(rows))
+        finally:
+            db.close()
 
 # ============================================================================
 # AUTHENTICATION ENDPOINTS
@@ -110,13 +258,16 @@ def log_privacy_action(db: Session, user_id: int, action: str, resource: str = N
 def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
     """Register a new user"""
     # Check if username exists
-    db_user = db.query(models.User).filter(models.User.username == user.username).first()
-    if db_user:
+    if db.query(models.User.id).filter(models.User.username == user.username).first():
         raise HTTPException(status_code=400, detail="Username already registered")
     
+    # Check if email exists (single lookup on the unique email_hash index)
+    email_hash = hash_data(user.email.strip().lower()) if user.email else None
+    if email_hash and db.query(models.User.id).filter(models.User.email_hash == email_hash).first():
+        raise HTTPException(status_code=400, detail="Email already registered")
+    
     # Create new user
     hashed_password = get_password_hash(user.password)
-    email_hash = hash_data(user.email) if user.email else None
     phone_hash = hash_data(user.phone) if user.phone else None
     
     db_user = models.User(
@@ -134,14 +285,16 @@ def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
     db.commit()
     db.refresh(db_user)
     
-    log_privacy_action(db, db_user.id, "USER_REGISTERED")
+    log_privacy_action(db_user.id, "USER_REGISTERED")
     
     return db_user
 
 @app.post("/api/auth/login", response_model=schemas.Token)
 def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     """Login and get access token"""
-    user = db.query(models.User).filter(models.User.username == form_data.username).first()
+    user = db.query(models.User).options(
+        undefer(models.User.password_hash)
+    ).filter(models.User.username == form_data.username).first()
     
     if not user or not verify_password(form_data.password, user.password_hash):
         raise HTTPException(
@@ -150,6 +303,10 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
             headers={"WWW-Authenticate": "Bearer"},
         )
     
+    # Upgrade hashes made with outdated Argon2 parameters
+    if password_needs_rehash(user.password_hash):
+        user.password_hash = get_password_hash(form_data.password)
+    
     # Update last login
     user.last_login = datetime.now()
     db.commit()
@@ -157,7 +314,7 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
     # Create access token
     access_token = create_access_token(data={"sub": user.username})
     
-    log_privacy_action(db, user.id, "USER_LOGIN")
+    log_privacy_action(user.id, "USER_LOGIN")
     
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -178,18 +335,32 @@ def get_services(
     db: Session = Depends(get_db)
 ):
     """Get all services with optional filtering"""
+    cache_key = (_services_cache_version, service_type, skip, limit)
+    cached = _services_cache.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        return Response(content=cached[1], media_type="application/json")
+    
     query = db.query(models.Service)
     
     if service_type:
         query = query.filter(models.Service.service_type == service_type)
     
     services = query.offset(skip).limit(limit).all()
-    return services
+    
+    # Cache the serialized body so hits skip both the DB and Pydantic
+    content = services_list_adapter.dump_json(services_list_adapter.validate_python(services))
+    if len(_services_cache) >= SERVICES_CACHE_MAX_ENTRIES:
+        _services_cache.clear()
+    _services_cache[cache_key] = (time.monotonic() + SERVICES_CACHE_TTL, content)
+    
+    return Response(content=content, media_type="application/json")
 
 @app.get("/api/services/{service_id}", response_model=schemas.ServiceResponse)
 def get_service(service_id: int, db: Session = Depends(get_db)):
     """Get specific service by ID"""
-    service = db.query(models.Service).filter(models.Service.id == service_id).first()
+    service = db.query(models.Service).options(*eager()).filter(
+        models.Service.id == service_id
+    ).first()
     if not service:
         raise HTTPException(status_code=404, detail="Service not found")
     return service
@@ -218,8 +389,9 @@ def create_service(
     db.add(db_service)
     db.commit()
     db.refresh(db_service)
+    invalidate_services_cache()
     
-    log_privacy_action(db, current_user.id, "SERVICE_CREATED")
+    log_privacy_action(current_user.id, "SERVICE_CREATED")
     
     return db_service
 
@@ -249,6 +421,7 @@ def update_service(
     
     db.commit()
     db.refresh(db_service)
+    invalidate_services_cache()
     
     return db_service
 
@@ -269,6 +442,7 @@ def delete_service(
     
     db.delete(db_service)
     db.commit()
+    invalidate_services_cache()
     
     return {"message": "Service deleted successfully"}
 
@@ -283,8 +457,10 @@ def create_booking(
     db: Session = Depends(get_db)
 ):
     """Create a new booking with payment"""
-    # Get service
-    service = db.query(models.Service).filter(models.Service.id == booking.service_id).first()
+    # Get service together with its provider in a single query
+    service = db.query(models.Service).options(
+        *eager(joinedload(models.Service.provider))
+    ).filter(models.Service.id == booking.service_id).first()
     if not service:
         raise HTTPException(status_code=404, detail="Service not found")
     
@@ -307,9 +483,9 @@ def create_booking(
         booking_date=booking.booking_date,
         booking_time=booking.booking_time,
         location_hash=hash_data(booking.location),
-        contact_trace_token=secrets.token_hex(16),
+        contact_trace_token=token_hex(16),
         privacy_level=booking.privacy_level,
-        otp_code=otp_code,
+        otp_hash=hash_otp(otp_code),
         otp_generated_at=datetime.now(),
         payment_status="paid_held",
         amount=payment_details['total'],
@@ -321,12 +497,12 @@ def create_booking(
         paid_at=datetime.now()
     )
     
+    # Flush to get the booking ID; everything below commits as one transaction
     db.add(db_booking)
-    db.commit()
-    db.refresh(db_booking)
+    db.flush()
     
     # Create contact event
-    provider = db.query(models.User).filter(models.User.id == service.provider_id).first()
+    provider = service.provider
     contact_event = models.ContactEvent(
         anonymous_id_1=current_user.anonymous_id,
         anonymous_id_2=provider.anonymous_id,
@@ -335,7 +511,6 @@ def create_booking(
         location_hash=db_booking.location_hash,
         proximity_level="close"
     )
-    db.add(contact_event)
     
     # Log payment transaction
     transaction = models.PaymentTransaction(
@@ -347,30 +522,38 @@ def create_booking(
         description=f"Payment of ${payment_details['total']:.2f} held in escrow",
         completed_at=datetime.now()
     )
-    db.add(transaction)
     
+    db.add_all([contact_event, transaction])
     db.commit()
+    db.refresh(db_booking)
+    
+    # Only the hash is stored; the client sees the plaintext OTP this once
+    db_booking.otp_code = otp_code
     
-    log_privacy_action(db, current_user.id, "BOOKING_CREATED", f"booking_{db_booking.id}")
+    log_privacy_action(db_booking.client_id, "BOOKING_CREATED", f"booking_{db_booking.id}")
     
     return db_booking
 
 @app.get("/api/bookings", response_model=List[schemas.BookingResponse])
 def get_bookings(
+    skip: int = 0,
+    limit: Optional[int] = None,
     current_user: models.User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Get all bookings for current user"""
+    """Get bookings for current user, streamed as a JSON array"""
     if current_user.role == "client":
-        bookings = db.query(models.Booking).filter(
-            models.Booking.client_id == current_user.id
-        ).all()
+        owned_by_user = models.Booking.client_id == current_user.id
     else:  # provider
-        bookings = db.query(models.Booking).filter(
-            models.Booking.provider_id == current_user.id
-        ).all()
+        owned_by_user = models.Booking.provider_id == current_user.id
+    
+    partitions = db.execute(
+        select(models.Booking).options(*eager()).where(owned_by_user)
+        .order_by(models.Booking.id).offset(skip).limit(limit)
+        .execution_options(yield_per=BOOKINGS_STREAM_BATCH_SIZE)
+    ).scalars().partitions()
     
-    return bookings
+    return StreamingResponse(stream_bookings(partitions), media_type="application/json")
 
 @app.get("/api/bookings/{booking_id}", response_model=schemas.BookingResponse)
 def get_booking(
@@ -405,14 +588,14 @@ def verify_otp(
     if booking.provider_id != current_user.id:
         raise HTTPException(status_code=403, detail="Only provider can verify OTP")
     
-    if booking.otp_code != otp_data.otp_code:
+    if not booking.otp_hash or not secrets.compare_digest(booking.otp_hash, hash_otp(otp_data.otp_code)):
         raise HTTPException(status_code=400, detail="Invalid OTP code")
     
     booking.otp_verified = True
     booking.status = "confirmed"
     db.commit()
     
-    log_privacy_action(db, current_user.id, "OTP_VERIFIED", f"booking_{booking_id}")
+    log_privacy_action(current_user.id, "OTP_VERIFIED", f"booking_{booking_id}")
     
     return {"message": "OTP verified successfully"}
 
@@ -451,7 +634,7 @@ def complete_booking(
         )
         db.add(transaction)
         
-        log_privacy_action(db, current_user.id, "PAYMENT_TRANSFERRED", f"booking_{booking_id}")
+        log_privacy_action(current_user.id, "PAYMENT_TRANSFERRED", f"booking_{booking_id}")
     
     db.commit()
     
@@ -478,26 +661,35 @@ def create_health_declaration(
         symptoms=declaration.symptoms,
         temperature=declaration.temperature,
         covid_test_result=declaration.covid_test_result,
-        declaration_hash=secrets.token_hex(16)
+        declaration_hash=token_hex(16)
     )
     
     db.add(db_declaration)
     db.commit()
     
     # If positive, trigger contact tracing
+    contacts_traced = 0
     if declaration.covid_test_result == "positive":
-        contacts = db.query(models.ContactEvent).filter(
-            (models.ContactEvent.anonymous_id_1 == current_user.anonymous_id) |
-            (models.ContactEvent.anonymous_id_2 == current_user.anonymous_id)
-        ).all()
+        # UNION ALL of two equality filters keeps each side on its own index
+        anonymous_id = current_user.anonymous_id
+        as_first = select(models.ContactEvent.id).where(
+            models.ContactEvent.anonymous_id_1 == anonymous_id
+        )
+        as_second = select(models.ContactEvent.id).where(
+            models.ContactEvent.anonymous_id_2 == anonymous_id,
+            models.ContactEvent.anonymous_id_1 != anonymous_id  # Already counted above
+        )
+        contacts_traced = db.scalar(
+            select(func.count()).select_from(union_all(as_first, as_second).subquery())
+        )
         
         # Update user health status
         current_user.health_status = "positive"
         db.commit()
         
-        log_privacy_action(db, current_user.id, "COVID_POSITIVE_REPORTED")
+        log_privacy_action(current_user.id, "COVID_POSITIVE_REPORTED")
     
-    return {"message": "Health declaration submitted", "contacts_traced": len(contacts) if declaration.covid_test_result == "positive" else 0}
+    return {"message": "Health declaration submitted", "contacts_traced": contacts_traced}
 
 # ============================================================================
 # STATISTICS ENDPOINTS
@@ -510,46 +702,43 @@ def get_dashboard_stats(
 ):
     """Get dashboard statistics"""
     if current_user.role == "client":
-        total_bookings = db.query(models.Booking).filter(
-            models.Booking.client_id == current_user.id
-        ).count()
-        
-        pending_bookings = db.query(models.Booking).filter(
-            models.Booking.client_id == current_user.id,
-            models.Booking.status.in_(["pending", "confirmed"])
-        ).count()
+        stats = db.execute(
+            select(
+                func.count().label("total_bookings"),
+                func.coalesce(func.sum(case(
+                    (models.Booking.status.in_(["pending", "confirmed"]), 1), else_=0
+                )), 0).label("pending_bookings")
+            ).where(models.Booking.client_id == current_user.id)
+        ).one()
         
         return {
-            "total_bookings": total_bookings,
-            "pending_bookings": pending_bookings,
+            "total_bookings": stats.total_bookings,
+            "pending_bookings": stats.pending_bookings,
             "role": "client"
         }
     else:  # provider
-        total_services = db.query(models.Service).filter(
+        total_services = select(func.count()).where(
             models.Service.provider_id == current_user.id
-        ).count()
-        
-        total_bookings = db.query(models.Booking).filter(
-            models.Booking.provider_id == current_user.id
-        ).count()
-        
-        completed_bookings = db.query(models.Booking).filter(
-            models.Booking.provider_id == current_user.id,
-            models.Booking.status == "completed"
-        ).count()
-        
-        total_earnings = db.query(models.Booking).filter(
-            models.Booking.provider_id == current_user.id,
-            models.Booking.payment_status == "transferred"
-        ).with_entities(models.Booking.provider_amount).all()
+        ).scalar_subquery()
         
-        earnings_sum = sum([e[0] for e in total_earnings if e[0]])
+        stats = db.execute(
+            select(
+                total_services.label("total_services"),
+                func.count().label("total_bookings"),
+                func.coalesce(func.sum(case(
+                    (models.Booking.status == "completed", 1), else_=0
+                )), 0).label("completed_bookings"),
+                func.coalesce(func.sum(case(
+                    (models.Booking.payment_status == "transferred", models.Booking.provider_amount), else_=0
+                )), 0).label("total_earnings")
+            ).where(models.Booking.provider_id == current_user.id)
+        ).one()
         
         return {
-            "total_services": total_services,
-            "total_bookings": total_bookings,
-            "completed_bookings": completed_bookings,
-            "total_earnings": earnings_sum,
+            "total_services": stats.total_services,
+            "total_bookings": stats.total_bookings,
+            "completed_bookings": stats.completed_bookings,
+            "total_earnings": stats.total_earnings,
             "role": "provider"
         }
 
@@ -2,8 +2,8 @@
 Database Models - SQLAlchemy ORM
 """
 
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Date, Time, Text, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Float, Numeric, Boolean, DateTime, Date, Time, Text, LargeBinary, ForeignKey, Index
+from sqlalchemy.orm import relationship, deferred
 from datetime import datetime
 from database import Base
 
@@ -12,8 +12,8 @@ class User(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True, nullable=False)
-    email_hash = Column(String)
-    password_hash = Column(String, nullable=False)
+    email_hash = Column(String, unique=True, index=True)
+    password_hash = deferred(Column(String, nullable=False))  # Only loaded for login
     role = Column(String, nullable=False)  # 'client' or 'provider'
     phone_hash = Column(String)
     anonymous_id = Column(String, unique=True, nullable=False)
@@ -31,13 +31,17 @@ class User(Base):
 
 class Service(Base):
     __tablename__ = "services"
+    __table_args__ = (
+        Index("ix_services_provider", "provider_id"),
+        Index("ix_services_type", "service_type"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     provider_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     service_type = Column(String, nullable=False)
     title = Column(String, nullable=False)
     description = Column(Text)
-    price = Column(Float, nullable=False)
+    price = Column(Numeric(10, 2), nullable=False)
     location_area = Column(String)
     covid_safe = Column(Boolean, default=True)
     max_distance = Column(Integer, default=10)
@@ -49,6 +53,11 @@ class Service(Base):
 
 class Booking(Base):
     __tablename__ = "bookings"
+    __table_args__ = (
+        Index("ix_bookings_client", "client_id"),
+        Index("ix_bookings_provider_status", "provider_id", "status"),
+        Index("ix_bookings_provider_pay", "provider_id", "payment_status"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     service_id = Column(Integer, ForeignKey("services.id"), nullable=False)
@@ -60,13 +69,13 @@ class Booking(Base):
     location_hash = Column(String, nullable=False)
     contact_trace_token = Column(String, unique=True, nullable=False)
     privacy_level = Column(String, default="standard")
-    otp_code = Column(String)
+    otp_hash = Column(LargeBinary)  # Keyed BLAKE3 of the OTP, never the plaintext
     otp_verified = Column(Boolean, default=False)
     otp_generated_at = Column(DateTime)
     payment_status = Column(String, default="pending")
-    amount = Column(Float)
-    platform_fee = Column(Float)
-    provider_amount = Column(Float)
+    amount = Column(Numeric(10, 2))
+    platform_fee = Column(Numeric(10, 2))
+    provider_amount = Column(Numeric(10, 2))
     card_last4 = Column(String)
     card_type = Column(String)
     payment_reference = Column(String)
@@ -88,7 +97,7 @@ class PaymentTransaction(Base):
     id = Column(Integer, primary_key=True, index=True)
     booking_id = Column(Integer, ForeignKey("bookings.id"), nullable=False)
     transaction_type = Column(String, nullable=False)
-    amount = Column(Float, nullable=False)
+    amount = Column(Numeric(10, 2), nullable=False)
     payment_reference = Column(String)
     status = Column(String, default="pending")
     description = Column(Text)
@@ -100,6 +109,10 @@ class PaymentTransaction(Base):
 
 class ContactEvent(Base):
     __tablename__ = "contact_events"
+    __table_args__ = (
+        Index("ix_contact_anon1", "anonymous_id_1"),
+        Index("ix_contact_anon2", "anonymous_id_2"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     anonymous_id_1 = Column(String, nullable=False)
@@ -2,9 +2,18 @@
 Pydantic Schemas for Request/Response validation
 """
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PlainSerializer
 from typing import Optional
+from typing_extensions import Annotated
 from datetime import datetime, date
+from decimal import Decimal
+
+# Money is fixed-point in Python and the DB, but a plain number in JSON
+Money = Annotated[
+    Decimal,
+    Field(max_digits=10, decimal_places=2),
+    PlainSerializer(float, return_type=float, when_used="json")
+]
 
 # ============================================================================
 # USER SCHEMAS
@@ -44,7 +53,7 @@ class ServiceBase(BaseModel):
     service_type: str
     title: str
     description: str
-    price: float
+    price: Money
     location_area: str
     covid_safe: bool = True
     max_distance: int = 10
@@ -88,9 +97,9 @@ class BookingResponse(BaseModel):
     otp_code: Optional[str] = None
     otp_verified: bool
     payment_status: str
-    amount: Optional[float] = None
-    platform_fee: Optional[float] = None
-    provider_amount: Optional[float] = None
+    amount: Optional[Money] = None
+    platform_fee: Optional[Money] = None
+    provider_amount: Optional[Money] = None
     card_last4: Optional[str] = None
     card_type: Optional[str] = None
     payment_reference: Optional[str] = None
@@ -123,7 +132,7 @@ class PaymentTransactionResponse(BaseModel):
     id: int
     booking_id: int
     transaction_type: str
-    amount: float
+    amount: Money
     payment_reference: Optional[str] = None
     status: str
     description: Optional[str] = None